@@ -1,9 +1,116 @@
 import argparse
 import os
 import sqlite3
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional
 
-from .session import SQLAlchemySession
+from sqlalchemy.engine import make_url
+from telethon.crypto import AuthKey
+from telethon.sessions.memory import _SentFileType as _SFT
+
+from .session import (
+    Entity,
+    SentFile,
+    SQLAlchemySession,
+    UpdateState,
+    _create_engine,
+    _ensure_schema,
+    _evict_duplicate_usernames,
+    _upsert,
+)
+
+# Rows fetched from the legacy file and upserted per round-trip
+BATCH_SIZE = 10_000
+
+_CACHEABLE_FILE_TYPES = (_SFT.DOCUMENT.value, _SFT.PHOTO.value)
+
+_ENTITY_COLUMNS = ("session_name", "id", "hash", "username", "phone", "name", "date")
+
+
+def _fetch_batches(cur: sqlite3.Cursor, query: str) -> Iterator[List[tuple]]:
+    """
+    Yield the rows of ``query`` in lists of at most ``BATCH_SIZE`` so memory
+    stays bounded on large files. Yields nothing if the table does not exist.
+    """
+    try:
+        cur.execute(query)
+    except sqlite3.OperationalError:
+        return
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def _entity_values(session_name: str, row: tuple, now_ts: int) -> tuple:
+    ent_id, ent_hash, username, phone, name, date = row
+    return (
+        session_name,
+        ent_id,
+        ent_hash,
+        username.lower() if username else None,
+        phone,
+        name,
+        date or now_ts,
+    )
+
+
+def _upsert_entities(
+    s, session_name: str, batches: Iterable[List[tuple]], now_ts: int
+) -> bool:
+    """Upsert legacy entity rows batch by batch; return whether any had a username."""
+    has_usernames = False
+    for rows in batches:
+        _upsert(
+            s,
+            Entity,
+            [
+                dict(zip(_ENTITY_COLUMNS, _entity_values(session_name, row, now_ts)))
+                for row in rows
+            ],
+            _ENTITY_COLUMNS[2:],
+        )
+        has_usernames = has_usernames or any(row[2] for row in rows)
+    return has_usernames
+
+
+def _supports_copy(s) -> bool:
+    dialect = s.get_bind().dialect
+    return dialect.name == "postgresql" and dialect.driver == "psycopg"
+
+
+def _copy_entities(
+    s, session_name: str, batches: Iterable[List[tuple]], now_ts: int
+) -> bool:
+    """
+    Postgres (psycopg 3) variant of ``_upsert_entities``: stream the rows with
+    COPY into a temporary table, then merge it into ``entities`` with a single
+    INSERT ... SELECT ... ON CONFLICT, since COPY itself cannot upsert.
+    """
+    table = Entity.__tablename__
+    columns = ", ".join(_ENTITY_COLUMNS)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in _ENTITY_COLUMNS[2:])
+    has_usernames = False
+    # Use the session's own connection so the load joins its transaction
+    pg = s.connection().connection.driver_connection
+    with pg.cursor() as pg_cur:
+        pg_cur.execute(
+            f"CREATE TEMP TABLE _migrated_{table} "
+            f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        with pg_cur.copy(f"COPY _migrated_{table} ({columns}) FROM STDIN") as copy:
+            for rows in batches:
+                for row in rows:
+                    copy.write_row(_entity_values(session_name, row, now_ts))
+                has_usernames = has_usernames or any(row[2] for row in rows)
+        pg_cur.execute(
+            f"INSERT INTO {table} ({columns}) "
+            f"SELECT {columns} FROM _migrated_{table} "
+            f"ON CONFLICT (session_name, id) DO UPDATE SET {updates}"
+        )
+    return has_usernames
 
 
 def migrate_sqlite_to_sqlalchemy(
@@ -20,6 +127,7 @@ def migrate_sqlite_to_sqlalchemy(
         session_name = base or "default"
 
     conn = sqlite3.connect(sqlite_path)
+    dst = None
     try:
         cur = conn.cursor()
 
@@ -31,115 +139,127 @@ def migrate_sqlite_to_sqlalchemy(
             "select dc_id, server_address, port, auth_key, takeout_id from sessions"
         )
         row = cur.fetchone()
-        if row:
-            dc_id, server_address, port, auth_key, takeout_id = row
-            dst.set_dc(dc_id, server_address, port)
-            if auth_key:
-                # AuthKey expects raw bytes; Telethon stores raw bytes
-                from telethon.crypto import AuthKey
 
-                dst.auth_key = AuthKey(data=auth_key)
-            dst.takeout_id = takeout_id
+        # Migrate the session row, entities, update_state and sent_files in a
+        # single transaction, so a failed load never leaves a live auth key
+        # behind without the data that goes with it
+        now_ts = int(time.time())
+        with dst.bulk():
+            if row:
+                dc_id, server_address, port, auth_key, takeout_id = row
+                dst.set_dc(dc_id, server_address, port)
+                if auth_key:
+                    # AuthKey expects raw bytes; Telethon stores raw bytes
+                    dst.auth_key = AuthKey(data=auth_key)
+                dst.takeout_id = takeout_id
 
-        # Migrate entities
-        try:
-            cur.execute("select id, hash, username, phone, name, date from entities")
-            rows = cur.fetchall()
-        except sqlite3.OperationalError:
-            rows = []
-
-        if rows:
-            # Use internal methods that mirror SQLiteSession semantics
-            from telethon_sql.session import Entity
-            import time as _time
-
-            now_ts = int(_time.time())
-
-            # Insert preserving most recent username
-            from sqlalchemy import select, update
-
-            with dst._SessionLocal() as s:  # type: ignore[attr-defined]
-                for ent_id, ent_hash, username, phone, name, date in rows:
-                    s.merge(
-                        Entity(
-                            session_name=dst.session_name,
-                            id=ent_id,
-                            hash=ent_hash,
-                            username=(username.lower() if username else None),
-                            phone=phone,
-                            name=name,
-                            date=date or now_ts,
-                        )
+            # Joins the transaction the session-row writes above left pending
+            with dst._write_session() as s:  # type: ignore[attr-defined]
+                batches = _fetch_batches(
+                    cur, "select id, hash, username, phone, name, date from entities"
+                )
+                if _supports_copy(s):
+                    has_usernames = _copy_entities(s, dst.session_name, batches, now_ts)
+                else:
+                    has_usernames = _upsert_entities(
+                        s, dst.session_name, batches, now_ts
                     )
-                    if username:
-                        dups = s.execute(
-                            select(Entity.id, Entity.date)
-                            .where(Entity.session_name == dst.session_name)
-                            .where(Entity.username == username.lower())
-                            .order_by(Entity.date.asc().nullsfirst())
-                        ).all()
-                        if len(dups) > 1:
-                            ids_to_null = [t[0] for t in dups[:-1]]
-                            if ids_to_null:
-                                s.execute(
-                                    update(Entity)
-                                    .where(Entity.session_name == dst.session_name)
-                                    .where(Entity.id.in_(ids_to_null))
-                                    .values(username=None)
-                                )
-                s.commit()
-
-        # Migrate update_state
-        try:
-            cur.execute("select id, pts, qts, date, seq from update_state")
-            rows = cur.fetchall()
-        except sqlite3.OperationalError:
-            rows = []
-
-        for eid, pts, qts, date, seq in rows:
-            from telethon.tl import types as tl_types
-            import datetime
-
-            state = tl_types.updates.State(
-                pts=pts,
-                qts=qts,
-                date=datetime.datetime.fromtimestamp(date),
-                seq=seq,
-                unread_count=0,
-            )
-            dst.set_update_state(eid, state)
-
-        # Migrate sent_files
-        try:
-            cur.execute("select md5_digest, file_size, type, id, hash from sent_files")
-            rows = cur.fetchall()
-        except sqlite3.OperationalError:
-            rows = []
+                # Preserve only the most recent entity per username; nothing can
+                # collide if no migrated entity carried one
+                if has_usernames:
+                    _evict_duplicate_usernames(s, dst.session_name)
 
-        from telethon.tl.types import InputPhoto, InputDocument
-        from telethon.sessions.memory import _SentFileType as _SFT
+                # Migrate update_state; dates are already stored as Unix timestamps
+                for rows in _fetch_batches(
+                    cur, "select id, pts, qts, date, seq from update_state"
+                ):
+                    _upsert(
+                        s,
+                        UpdateState,
+                        [
+                            {
+                                "session_name": dst.session_name,
+                                "id": eid,
+                                "pts": pts,
+                                "qts": qts,
+                                "date": date,
+                                "seq": seq,
+                            }
+                            for eid, pts, qts, date, seq in rows
+                        ],
+                        ("pts", "qts", "date", "seq"),
+                    )
 
-        for md5_digest, file_size, type_value, fid, fh in rows:
-            if type_value == _SFT.DOCUMENT.value:
-                dst.cache_file(md5_digest, file_size, InputDocument(fid, fh))
-            elif type_value == _SFT.PHOTO.value:
-                dst.cache_file(md5_digest, file_size, InputPhoto(fid, fh))
+                # Migrate sent_files, skipping types this backend cannot cache
+                for rows in _fetch_batches(
+                    cur, "select md5_digest, file_size, type, id, hash from sent_files"
+                ):
+                    _upsert(
+                        s,
+                        SentFile,
+                        [
+                            {
+                                "session_name": dst.session_name,
+                                "md5_digest": md5_digest,
+                                "file_size": file_size,
+                                "type": type_value,
+                                "id": fid,
+                                "hash": fh,
+                            }
+                            for md5_digest, file_size, type_value, fid, fh in rows
+                            if type_value in _CACHEABLE_FILE_TYPES
+                        ],
+                        ("id", "hash"),
+                    )
 
     finally:
+        if dst is not None:
+            dst.close()
         conn.close()
 
 
-def migrate_directory(dir_path: str, db_url: str) -> None:
+def migrate_directory(
+    dir_path: str, db_url: str, max_workers: Optional[int] = None
+) -> None:
     if not os.path.isdir(dir_path):
         raise NotADirectoryError(dir_path)
-    for entry in os.listdir(dir_path):
-        if entry.endswith(".session"):
-            src = os.path.join(dir_path, entry)
-            try:
-                migrate_sqlite_to_sqlalchemy(src, db_url, None)
+    sources = [
+        os.path.join(dir_path, entry)
+        for entry in os.listdir(dir_path)
+        if entry.endswith(".session")
+    ]
+    if not sources:
+        return
+
+    # Set up the schema once so concurrent workers do not race on DDL
+    engine = _create_engine(db_url)
+    try:
+        _ensure_schema(engine)
+    finally:
+        engine.dispose()
+
+    def migrate_one(src: str) -> Optional[Exception]:
+        try:
+            migrate_sqlite_to_sqlalchemy(src, db_url, None)
+        except Exception as e:
+            return e
+        return None
+
+    if make_url(db_url).get_backend_name() == "sqlite":
+        # SQLite allows a single writer, and each migration holds one write
+        # transaction for its whole file; concurrent workers would only wait
+        # out busy_timeout and fail with "database is locked"
+        workers = 1
+    else:
+        # Files are independent; keep the worker count small so each worker's
+        # connection pool does not exhaust the destination database
+        workers = max_workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for src, err in zip(sources, executor.map(migrate_one, sources)):
+            if err is None:
                 print(f"Migrated: {src}")
-            except Exception as e:
-                print(f"Failed: {src} -> {e}")
+            else:
+                print(f"Failed: {src} -> {err}")
 
 
 def main() -> None:
@@ -162,13 +282,22 @@ def main() -> None:
     batch.add_argument(
         "db_url", help="SQLAlchemy DB URL (e.g., postgresql+psycopg://..."
     )
+    batch.add_argument(
+        "--workers",
+        dest="max_workers",
+        type=int,
+        help=(
+            "Number of files migrated concurrently (defaults to min(8, CPUs); "
+            "always 1 for SQLite destinations)"
+        ),
+    )
 
     args = parser.parse_args()
 
     if args.cmd == "one":
         migrate_sqlite_to_sqlalchemy(args.sqlite_path, args.db_url, args.session_name)
     elif args.cmd == "dir":
-        migrate_directory(args.dir_path, args.db_url)
+        migrate_directory(args.dir_path, args.db_url, args.max_workers)
     else:
         parser.print_help()
 
@@ -1,7 +1,9 @@
+import contextlib
 import datetime
+import functools
 import time
 
-from typing import Iterable, Tuple
+from typing import Iterable, Iterator, Tuple
 
 from telethon.tl import types as tl_types
 from telethon.sessions.memory import MemorySession, _SentFileType
@@ -22,25 +24,37 @@ try:
         BigInteger,
         String,
         LargeBinary,
+        MetaData,
+        Table,
+        Index,
         create_engine,
+        event,
         UniqueConstraint,
+        bindparam,
+        inspect,
         select,
         update,
         delete,
         func,
     )
+    from sqlalchemy.dialects import mysql, postgresql, sqlite as sqlite_dialect
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.pool import QueuePool, StaticPool
     from sqlalchemy.orm import declarative_base, sessionmaker, Session as SASession
 
     _sqlalchemy_err = None
 except Exception as e:  # pragma: no cover - import-time guard only
-    Column = Integer = BigInteger = String = LargeBinary = create_engine = (
-        UniqueConstraint
-    ) = select = update = delete = func = None
+    Column = Integer = BigInteger = String = LargeBinary = MetaData = Table = Index = (
+        create_engine
+    ) = event = UniqueConstraint = bindparam = inspect = select = update = delete = (
+        func
+    ) = None
+    mysql = postgresql = sqlite_dialect = make_url = QueuePool = StaticPool = None
     declarative_base = sessionmaker = SASession = None
     _sqlalchemy_err = type(e)
 
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 2
 
 Base = declarative_base() if declarative_base else None
 
@@ -64,11 +78,16 @@ class SessionRow(Base):  # type: ignore[misc]
 
 class Entity(Base):  # type: ignore[misc]
     __tablename__ = "entities"
+    __table_args__ = (
+        Index("ix_entities_sn_username", "session_name", "username"),
+        Index("ix_entities_sn_phone", "session_name", "phone"),
+        Index("ix_entities_sn_name", "session_name", "name"),
+    )
 
     session_name = Column(String(255), primary_key=True)
     id = Column(BigInteger, primary_key=True)
     hash = Column(BigInteger, nullable=False)
-    username = Column(String(255), nullable=True, index=True)
+    username = Column(String(255), nullable=True)
     phone = Column(String(64), nullable=True)
     name = Column(String(255), nullable=True)
     date = Column(BigInteger, nullable=True)
@@ -96,6 +115,274 @@ class UpdateState(Base):  # type: ignore[misc]
     seq = Column(BigInteger)
 
 
+# Hot-path lookups are built once; values are bound per call, so SQLAlchemy can
+# reuse the compiled statement instead of constructing the query every time
+_Q_SESSION = select(
+    SessionRow.dc_id,
+    SessionRow.server_address,
+    SessionRow.port,
+    SessionRow.auth_key,
+    SessionRow.takeout_id,
+).where(SessionRow.session_name == bindparam("sn"))
+
+# SET columns are taken from the execution parameters
+_U_SESSION = update(SessionRow.__table__).where(
+    SessionRow.__table__.c.session_name == bindparam("sn")
+)
+
+_Q_UPDATE_STATE = (
+    select(UpdateState.pts, UpdateState.qts, UpdateState.date, UpdateState.seq)
+    .where(UpdateState.session_name == bindparam("sn"))
+    .where(UpdateState.id == bindparam("id"))
+)
+
+_Q_UPDATE_STATES = (
+    select(
+        UpdateState.id,
+        UpdateState.pts,
+        UpdateState.qts,
+        UpdateState.date,
+        UpdateState.seq,
+    )
+    .where(UpdateState.session_name == bindparam("sn"))
+    .execution_options(yield_per=1000)
+)
+
+_Q_ENTITY_BY_PHONE = (
+    select(Entity.id, Entity.hash)
+    .where(Entity.session_name == bindparam("sn"))
+    .where(Entity.phone == bindparam("phone"))
+)
+
+# Newest holder first; a second row only tells us there are duplicates to evict
+_Q_ENTITY_BY_USERNAME = (
+    select(Entity.id, Entity.hash)
+    .where(Entity.session_name == bindparam("sn"))
+    .where(Entity.username == bindparam("username"))
+    .order_by(func.coalesce(Entity.date, 0).desc())
+    .limit(2)
+)
+
+_Q_ENTITY_BY_NAME = (
+    select(Entity.id, Entity.hash)
+    .where(Entity.session_name == bindparam("sn"))
+    .where(Entity.name == bindparam("name"))
+)
+
+_Q_ENTITY_BY_ID = (
+    select(Entity.id, Entity.hash)
+    .where(Entity.session_name == bindparam("sn"))
+    .where(Entity.id == bindparam("id"))
+)
+
+_Q_ENTITY_BY_IDS = (
+    select(Entity.id, Entity.hash)
+    .where(Entity.session_name == bindparam("sn"))
+    .where(Entity.id.in_(bindparam("ids", expanding=True)))
+)
+
+_Q_FILE = (
+    select(SentFile.id, SentFile.hash)
+    .where(SentFile.session_name == bindparam("sn"))
+    .where(SentFile.md5_digest == bindparam("md5"))
+    .where(SentFile.file_size == bindparam("size"))
+    .where(SentFile.type == bindparam("type"))
+)
+
+
+_SFT_BY_CLS = {
+    InputPhoto: _SentFileType.PHOTO.value,
+    InputDocument: _SentFileType.DOCUMENT.value,
+}
+
+
+def _sent_file_type(cls) -> int:
+    try:
+        return _SFT_BY_CLS[cls]
+    except KeyError:
+        # Let Telethon raise its usual error for unsupported types
+        return _SentFileType.from_type(cls).value
+
+
+@functools.lru_cache(maxsize=4096)
+def _peer_id_candidates(id) -> Tuple[int, int, int]:
+    """Marked ids ``id`` may have been stored under as a user, chat or channel."""
+    return (
+        utils.get_peer_id(PeerUser(id)),
+        utils.get_peer_id(PeerChat(id)),
+        utils.get_peer_id(PeerChannel(id)),
+    )
+
+
+# Applied to every new SQLite connection; SQLite does not persist these per file
+# (except journal_mode), so each pooled connection must set them itself
+_SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "busy_timeout=5000",
+    "temp_store=MEMORY",
+    "cache_size=-20000",
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in _SQLITE_PRAGMAS:
+            cursor.execute("PRAGMA " + pragma)
+    finally:
+        cursor.close()
+
+
+def _create_engine(db_url: str):
+    """
+    Create an engine whose pool keeps connections open between operations.
+
+    In-memory SQLite shares one connection (each new connection would be a new,
+    empty database); everything else gets a bounded ``QueuePool``. SQLite
+    connections are switched to WAL so readers do not block the writer.
+    """
+    url = make_url(db_url)
+    kwargs = dict(
+        future=True,
+        query_cache_size=1200,
+        poolclass=QueuePool,
+        pool_size=5,
+        max_overflow=10,
+    )
+    if url.get_backend_name() != "sqlite":
+        return create_engine(url, pool_pre_ping=True, **kwargs)
+
+    kwargs["connect_args"] = {"check_same_thread": False}
+    if url.database in (None, "", ":memory:"):
+        # Pool sizing does not apply to the single shared connection
+        del kwargs["pool_size"], kwargs["max_overflow"]
+        kwargs["poolclass"] = StaticPool
+    engine = create_engine(url, **kwargs)
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def _upsert(s, model, values, update_columns) -> None:
+    """
+    Insert ``values`` (a list of column dicts) into ``model``'s table in one
+    statement, overwriting ``update_columns`` when the primary key exists.
+
+    Uses the native UPSERT of Postgres, SQLite and MySQL/MariaDB; other dialects
+    fall back to one ORM merge per row.
+    """
+    if not values:
+        return
+    table = model.__table__
+    dialect = s.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite_dialect.insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[c.name for c in table.primary_key],
+            set_={c: stmt.excluded[c] for c in update_columns},
+        )
+    elif dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            {c: stmt.inserted[c] for c in update_columns}
+        )
+    else:
+        for v in values:
+            s.merge(model(**v))
+        return
+    s.execute(stmt, values)
+
+
+def _insert_missing(s, model, values) -> None:
+    """
+    Insert ``values`` into ``model``'s table, silently skipping rows whose
+    primary key already exists (e.g. created concurrently by another process).
+    """
+    if not values:
+        return
+    table = model.__table__
+    dialect = s.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite_dialect.insert
+        stmt = insert(table).on_conflict_do_nothing(
+            index_elements=[c.name for c in table.primary_key]
+        )
+    elif dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(table).prefix_with("IGNORE")
+    else:
+        for v in values:
+            s.merge(model(**v))
+        return
+    s.execute(stmt, values)
+
+
+def _evict_duplicate_usernames(s, session_name: str) -> None:
+    """
+    Null the username of every entity in ``session_name`` that shares it with a
+    newer entity, so at most one row per username remains.
+    """
+    duplicated = (
+        select(Entity.username)
+        .where(Entity.session_name == session_name)
+        .where(Entity.username.is_not(None))
+        .group_by(Entity.username)
+        .having(func.count() > 1)
+    )
+    rows = s.execute(
+        select(Entity.username, Entity.id)
+        .where(Entity.session_name == session_name)
+        .where(Entity.username.in_(duplicated))
+        .order_by(Entity.username, func.coalesce(Entity.date, 0), Entity.id)
+    ).all()
+    # Rows are ordered oldest first, so the last id seen per username is kept
+    newest = {username: ent_id for username, ent_id in rows}
+    ids_to_null = [ent_id for username, ent_id in rows if newest[username] != ent_id]
+    for i in range(0, len(ids_to_null), 500):
+        s.execute(
+            update(Entity)
+            .where(Entity.session_name == session_name)
+            .where(Entity.id.in_(ids_to_null[i : i + 500]))
+            .values(username=None)
+        )
+
+
+def _ensure_schema(engine) -> None:
+    """Create missing tables and bring an existing schema up to date."""
+    Base.metadata.create_all(engine)
+    with SASession(bind=engine) as s:
+        existing = s.get(Version, DATABASE_VERSION)
+        if not existing:
+            # One row is recorded per applied schema version. A database without
+            # the current one is either new or needs the v1 -> v2 index swap
+            # (a no-op on new databases, which create_all() already indexed).
+            _upgrade_entity_indexes(engine)
+            _insert_missing(s, Version, [{"version": DATABASE_VERSION}])
+            s.commit()
+
+
+def _upgrade_entity_indexes(engine) -> None:
+    # Version 1 indexed username alone; create_all() never touches indexes of
+    # tables that already exist, so swap in the session-scoped ones here.
+    legacy = Table(
+        Entity.__tablename__,
+        MetaData(),
+        Column("username", String(255)),
+        Index("ix_entities_username", "username"),
+    )
+    for index in legacy.indexes:
+        index.drop(engine, checkfirst=True)
+    for index in Entity.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def _bulk_failed_error() -> RuntimeError:
+    return RuntimeError(
+        "the bulk() batch failed and was rolled back; no further writes are "
+        "accepted until the outermost block exits"
+    )
+
+
 class SQLAlchemySession(MemorySession):
     """
     Session backend for Telethon powered by SQLAlchemy.
@@ -110,14 +397,19 @@ class SQLAlchemySession(MemorySession):
             raise _sqlalchemy_err
 
         super().__init__()
-        self._engine = create_engine(db_url, future=True)
+        self._engine = _create_engine(db_url)
         self._SessionLocal = sessionmaker(
             bind=self._engine, expire_on_commit=False, class_=SASession, future=True
         )
         self.session_name = session_name
         self.save_entities = True
+        # DB session holding writes made with commit=False or inside bulk(), if any
+        self._pending = None
+        self._bulk_depth = 0
+        # Set when a write or inner block fails inside bulk(); the batch is then lost
+        self._bulk_failed = False
 
-        self._ensure_schema()
+        _ensure_schema(self._engine)
         self._load_existing_session()
 
     def clone(self, to_instance=None):
@@ -129,19 +421,9 @@ class SQLAlchemySession(MemorySession):
 
     # region Schema / Setup
 
-    def _ensure_schema(self) -> None:
-        Base.metadata.create_all(self._engine)
-        with self._SessionLocal() as s:
-            existing = s.get(Version, DATABASE_VERSION)
-            if not existing:
-                # Initialize or upgrade version row. Keep it simple and single-row.
-                # If older versions are ever needed, migration logic would go here.
-                s.merge(Version(version=DATABASE_VERSION))
-                s.commit()
-
     def _load_existing_session(self) -> None:
         with self._SessionLocal() as s:
-            row = s.get(SessionRow, self.session_name)
+            row = s.execute(_Q_SESSION, {"sn": self.session_name}).first()
             if row:
                 self._dc_id = row.dc_id or 0
                 self._server_address = row.server_address
@@ -150,16 +432,21 @@ class SQLAlchemySession(MemorySession):
                 self._auth_key = AuthKey(data=row.auth_key) if row.auth_key else None
 
             else:
-                # Create initial session row
-                s.merge(
-                    SessionRow(
-                        session_name=self.session_name,
-                        dc_id=self._dc_id,
-                        server_address=self._server_address,
-                        port=self._port,
-                        auth_key=b"",
-                        takeout_id=self._takeout_id,
-                    )
+                # Create initial session row; the conflict-tolerant INSERT covers
+                # another process creating it between the SELECT above and here
+                _insert_missing(
+                    s,
+                    SessionRow,
+                    [
+                        {
+                            "session_name": self.session_name,
+                            "dc_id": self._dc_id,
+                            "server_address": self._server_address,
+                            "port": self._port,
+                            "auth_key": b"",
+                            "takeout_id": self._takeout_id,
+                        }
+                    ],
                 )
                 s.commit()
 
@@ -169,14 +456,9 @@ class SQLAlchemySession(MemorySession):
 
     def set_dc(self, dc_id, server_address, port):
         super().set_dc(dc_id, server_address, port)
+        # The row now stores exactly the in-memory auth_key for the current
+        # (single) DC, so there is nothing to read back
         self._update_session_row()
-        # Fetch auth_key for current (single) DC stored in sessions row
-        with self._SessionLocal() as s:
-            row = s.get(SessionRow, self.session_name)
-            if row and row.auth_key:
-                self._auth_key = AuthKey(data=row.auth_key)
-            else:
-                self._auth_key = None
 
     @MemorySession.auth_key.setter
     def auth_key(self, value):
@@ -188,29 +470,33 @@ class SQLAlchemySession(MemorySession):
         self._takeout_id = value
         self._update_session_row()
 
-    def _update_session_row(self) -> None:
-        with self._SessionLocal() as s:
-            s.merge(
-                SessionRow(
-                    session_name=self.session_name,
-                    dc_id=self._dc_id,
-                    server_address=self._server_address,
-                    port=self._port,
-                    auth_key=self._auth_key.key if self._auth_key else b"",
-                    takeout_id=self._takeout_id,
+    def _update_session_row(self, commit: bool = True) -> None:
+        values = {
+            "dc_id": self._dc_id,
+            "server_address": self._server_address,
+            "port": self._port,
+            "auth_key": self._auth_key.key if self._auth_key else b"",
+            "takeout_id": self._takeout_id,
+        }
+        with self._write_session(commit) as s:
+            # _load_existing_session guarantees the row, so a plain UPDATE does
+            # instead of merge()'s SELECT-then-UPDATE
+            result = s.execute(_U_SESSION, {"sn": self.session_name, **values})
+            if not result.rowcount:
+                # Row was removed (e.g. by delete()); recreate it
+                _insert_missing(
+                    s, SessionRow, [{"session_name": self.session_name, **values}]
                 )
-            )
-            s.commit()
 
     # endregion
 
     # region Update state
 
     def get_update_state(self, entity_id):
-        with self._SessionLocal() as s:
-            row = s.get(
-                UpdateState, {"session_name": self.session_name, "id": entity_id}
-            )
+        with self._read_session() as s:
+            row = s.execute(
+                _Q_UPDATE_STATE, {"sn": self.session_name, "id": entity_id}
+            ).first()
             if row:
                 date = (
                     datetime.datetime.fromtimestamp(row.date, tz=datetime.timezone.utc)
@@ -221,8 +507,8 @@ class SQLAlchemySession(MemorySession):
                     row.pts, row.qts, date, row.seq, unread_count=0
                 )
 
-    def set_update_state(self, entity_id, state):
-        with self._SessionLocal() as s:
+    def set_update_state(self, entity_id, state, commit: bool = True):
+        with self._write_session(commit) as s:
             s.merge(
                 UpdateState(
                     session_name=self.session_name,
@@ -233,52 +519,138 @@ class SQLAlchemySession(MemorySession):
                     seq=state.seq,
                 )
             )
-            s.commit()
 
     def get_update_states(self) -> Iterable[Tuple[int, tl_types.updates.State]]:
-        with self._SessionLocal() as s:
-            rows = (
-                s.execute(
-                    select(UpdateState).where(
-                        UpdateState.session_name == self.session_name
+        """
+        Stream the stored update states, converting rows only as they are read.
+
+        The DB session, its cursor and (on PostgreSQL) the open transaction are
+        held until the iterator is exhausted or closed, so don't keep a
+        partially consumed iterator around; wrap it in ``list()`` if needed.
+        """
+        with self._read_session() as s:
+            result = s.execute(_Q_UPDATE_STATES, {"sn": self.session_name})
+            try:
+                for r in result:
+                    yield (
+                        r.id,
+                        tl_types.updates.State(
+                            pts=r.pts,
+                            qts=r.qts,
+                            date=datetime.datetime.fromtimestamp(
+                                r.date, tz=datetime.timezone.utc
+                            )
+                            if r.date
+                            else None,
+                            seq=r.seq,
+                            unread_count=0,
+                        ),
                     )
-                )
-                .scalars()
-                .all()
-            )
-            return (
-                (
-                    r.id,
-                    tl_types.updates.State(
-                        pts=r.pts,
-                        qts=r.qts,
-                        date=datetime.datetime.fromtimestamp(
-                            r.date, tz=datetime.timezone.utc
-                        )
-                        if r.date
-                        else None,
-                        seq=r.seq,
-                        unread_count=0,
-                    ),
-                )
-                for r in rows
-            )
+            finally:
+                # Closing early (break, close(), GC) releases the cursor right away
+                result.close()
 
     # endregion
 
     # region Persistence lifecycle
 
+    @contextlib.contextmanager
+    def _read_session(self) -> Iterator[SASession]:
+        # Reads go through the pending session, if any, so they see deferred writes
+        if self._pending is not None:
+            yield self._pending
+        else:
+            with self._SessionLocal() as s:
+                yield s
+
+    @contextlib.contextmanager
+    def _write_session(self, commit: bool = True) -> Iterator[SASession]:
+        if self._bulk_failed:
+            raise _bulk_failed_error()
+        s = self._pending if self._pending is not None else self._SessionLocal()
+        try:
+            yield s
+        except BaseException:
+            # Closing rolls back every write pending on s, so inside bulk() the
+            # batch is gone even if the caller catches this; make sure nothing
+            # written afterwards gets committed as if it were complete
+            self._rollback_pending(s)
+            if self._bulk_depth:
+                self._bulk_failed = True
+            raise
+        if commit and not self._bulk_depth:
+            self._pending = None
+            try:
+                s.commit()
+            finally:
+                s.close()
+        else:
+            self._pending = s
+
+    def _rollback_pending(self, s=None) -> None:
+        s = s or self._pending
+        self._pending = None
+        if s is not None:
+            s.close()
+
+    @contextlib.contextmanager
+    def bulk(self) -> Iterator["SQLAlchemySession"]:
+        """
+        Group every write made inside the block into a single transaction,
+        committed when the block exits and rolled back if it raises.
+
+        Nested blocks join the outermost one; there are no savepoints. If a
+        write or an inner block fails, the whole batch is rolled back even when
+        the caller catches the error: further writes raise ``RuntimeError`` and
+        so does leaving the outermost block.
+        """
+        self._bulk_depth += 1
+        try:
+            yield self
+        except BaseException:
+            # Nested blocks share the outermost transaction, so an error leaving
+            # any of them loses the whole batch, not just the inner writes
+            self._rollback_pending()
+            if self._bulk_depth > 1:
+                self._bulk_failed = True
+            raise
+        else:
+            if self._bulk_depth == 1:
+                if self._bulk_failed:
+                    self._rollback_pending()
+                    raise _bulk_failed_error()
+                self._commit_pending()
+        finally:
+            self._bulk_depth -= 1
+            if not self._bulk_depth:
+                self._bulk_failed = False
+
+    def _commit_pending(self) -> None:
+        s = self._pending
+        if s is None:
+            return
+        self._pending = None
+        try:
+            s.commit()
+        finally:
+            s.close()
+
     def save(self):
-        # Each operation commits; explicit save is a no-op but kept for interface parity
-        pass
+        # Operations commit as they go; this flushes writes deferred with
+        # commit=False. Telethon calls save() periodically, so inside a bulk()
+        # block it must wait for the block to exit to keep the batch atomic.
+        if self._bulk_depth:
+            return
+        self._commit_pending()
 
     def close(self):
+        self.save()
         # Dispose engine connections if any are open
         if self._engine:
             self._engine.dispose()
 
     def delete(self):
-        with self._SessionLocal() as s:
+        with self._write_session() as s:
             s.execute(
                 delete(SentFile).where(SentFile.session_name == self.session_name)
             )
@@ -289,25 +661,29 @@ class SQLAlchemySession(MemorySession):
             s.execute(
                 delete(SessionRow).where(SessionRow.session_name == self.session_name)
             )
-            s.commit()
         return True
 
     @classmethod
     def list_sessions(cls, db_url: str) -> Iterable[str]:
         if _sqlalchemy_err is not None:
             raise _sqlalchemy_err
+        # A plain engine on purpose: listing must not switch a SQLite file to WAL
         engine = create_engine(db_url, future=True)
         SessionLocal = sessionmaker(
             bind=engine, expire_on_commit=False, class_=SASession, future=True
         )
         try:
             with SessionLocal() as s:
-                if not engine.dialect.has_table(
-                    engine.connect(), SessionRow.__tablename__
-                ):
+                # Inspect through the session's own connection instead of opening
+                # (and leaking) a second one
+                if not inspect(s.connection()).has_table(SessionRow.__tablename__):
                     return []
-                names = s.execute(select(SessionRow.session_name)).scalars().all()
-                return list(sorted(set(names)))
+                names = s.execute(
+                    select(SessionRow.session_name)
+                    .distinct()
+                    .order_by(SessionRow.session_name)
+                ).scalars()
+                return list(names)
         finally:
             engine.dispose()
 
@@ -322,103 +698,85 @@ class SQLAlchemySession(MemorySession):
         if not rows:
             return
         now_ts = int(time.time())
-        with self._SessionLocal() as s:
-            for ent_id, ent_hash, username, phone, name in rows:
-                s.merge(
-                    Entity(
-                        session_name=self.session_name,
-                        id=ent_id,
-                        hash=ent_hash,
-                        username=username,
-                        phone=phone,
-                        name=name,
-                        date=now_ts,
-                    )
+        values = {}
+        # username -> id of the entity that now owns it; every other row holding
+        # the same username within this session is older and gets evicted
+        newest = {}
+        for ent_id, ent_hash, username, phone, name in rows:
+            values[ent_id] = {
+                "session_name": self.session_name,
+                "id": ent_id,
+                "hash": ent_hash,
+                "username": username,
+                "phone": phone,
+                "name": name,
+                "date": now_ts,
+            }
+            if username:
+                newest[username] = ent_id
+
+        with self._write_session() as s:
+            _upsert(
+                s,
+                Entity,
+                list(values.values()),
+                ("hash", "username", "phone", "name", "date"),
+            )
+            if newest:
+                s.execute(
+                    update(Entity)
+                    .where(Entity.session_name == self.session_name)
+                    .where(Entity.username.in_(list(newest)))
+                    .where(Entity.id.not_in(list(newest.values())))
+                    .values(username=None)
                 )
 
-                if username:
-                    # Evict older duplicates for the same username within the same session
-                    dups = s.execute(
-                        select(Entity.id, Entity.date)
-                        .where(Entity.session_name == self.session_name)
-                        .where(Entity.username == username)
-                        .order_by(Entity.date.asc().nullsfirst())
-                    ).all()
-                    if len(dups) > 1:
-                        # Keep the newest one (last), null others
-                        ids_to_null = [row[0] for row in dups[:-1]]
-                        if ids_to_null:
-                            s.execute(
-                                update(Entity)
-                                .where(Entity.session_name == self.session_name)
-                                .where(Entity.id.in_(ids_to_null))
-                                .values(username=None)
-                            )
-
-            s.commit()
-
     def get_entity_rows_by_phone(self, phone):
-        with self._SessionLocal() as s:
+        with self._read_session() as s:
             row = s.execute(
-                select(Entity.id, Entity.hash)
-                .where(Entity.session_name == self.session_name)
-                .where(Entity.phone == phone)
+                _Q_ENTITY_BY_PHONE, {"sn": self.session_name, "phone": phone}
             ).first()
             return row if row else None
 
     def get_entity_rows_by_username(self, username):
-        with self._SessionLocal() as s:
+        with self._read_session() as s:
             results = s.execute(
-                select(Entity.id, Entity.hash, Entity.date)
-                .where(Entity.session_name == self.session_name)
-                .where(Entity.username == username)
+                _Q_ENTITY_BY_USERNAME, {"sn": self.session_name, "username": username}
             ).all()
-            if not results:
-                return None
-            if len(results) > 1:
-                results.sort(key=lambda t: t[2] or 0)
-                ids_to_null = [t[0] for t in results[:-1]]
-                if ids_to_null:
-                    s.execute(
-                        update(Entity)
-                        .where(Entity.session_name == self.session_name)
-                        .where(Entity.id.in_(ids_to_null))
-                        .values(username=None)
-                    )
-                    s.commit()
-            return results[-1][0], results[-1][1]
+        if not results:
+            return None
+        newest_id, newest_hash = results[0]
+        if len(results) > 1:
+            # Evicting is a write, but it must not flush writes deferred with
+            # commit=False; join them instead if any are pending
+            with self._write_session(commit=self._pending is None) as s:
+                s.execute(
+                    update(Entity)
+                    .where(Entity.session_name == self.session_name)
+                    .where(Entity.username == username)
+                    .where(Entity.id != newest_id)
+                    .values(username=None)
+                )
+        return newest_id, newest_hash
 
     def get_entity_rows_by_name(self, name):
-        with self._SessionLocal() as s:
+        with self._read_session() as s:
             row = s.execute(
-                select(Entity.id, Entity.hash)
-                .where(Entity.session_name == self.session_name)
-                .where(Entity.name == name)
+                _Q_ENTITY_BY_NAME, {"sn": self.session_name, "name": name}
             ).first()
             return row if row else None
 
     def get_entity_rows_by_id(self, id, exact=True):
-        with self._SessionLocal() as s:
+        with self._read_session() as s:
             if exact:
                 row = s.execute(
-                    select(Entity.id, Entity.hash)
-                    .where(Entity.session_name == self.session_name)
-                    .where(Entity.id == id)
+                    _Q_ENTITY_BY_ID, {"sn": self.session_name, "id": id}
                 ).first()
                 return row if row else None
             else:
                 row = s.execute(
-                    select(Entity.id, Entity.hash)
-                    .where(Entity.session_name == self.session_name)
-                    .where(
-                        Entity.id.in_(
-                            [
-                                utils.get_peer_id(PeerUser(id)),
-                                utils.get_peer_id(PeerChat(id)),
-                                utils.get_peer_id(PeerChannel(id)),
-                            ]
-                        )
-                    )
+                    _Q_ENTITY_BY_IDS,
+                    {"sn": self.session_name, "ids": list(_peer_id_candidates(id))},
                 ).first()
                 return row if row else None
 
@@ -431,31 +789,37 @@ class SQLAlchemySession(MemorySession):
     # region File cache
 
     def get_file(self, md5_digest, file_size, cls):
-        with self._SessionLocal() as s:
+        with self._read_session() as s:
             row = s.execute(
-                select(SentFile.id, SentFile.hash)
-                .where(SentFile.session_name == self.session_name)
-                .where(SentFile.md5_digest == md5_digest)
-                .where(SentFile.file_size == file_size)
-                .where(SentFile.type == _SentFileType.from_type(cls).value)
+                _Q_FILE,
+                {
+                    "sn": self.session_name,
+                    "md5": md5_digest,
+                    "size": file_size,
+                    "type": _sent_file_type(cls),
+                },
             ).first()
             if row:
                 return cls(row[0], row[1])
 
-    def cache_file(self, md5_digest, file_size, instance):
+    def cache_file(self, md5_digest, file_size, instance, commit: bool = True):
         if not isinstance(instance, (InputDocument, InputPhoto)):
             raise TypeError("Cannot cache %s instance" % type(instance))
-        with self._SessionLocal() as s:
-            s.merge(
-                SentFile(
-                    session_name=self.session_name,
-                    md5_digest=md5_digest,
-                    file_size=file_size,
-                    type=_SentFileType.from_type(type(instance)).value,
-                    id=instance.id,
-                    hash=instance.access_hash,
-                )
+        with self._write_session(commit) as s:
+            _upsert(
+                s,
+                SentFile,
+                [
+                    {
+                        "session_name": self.session_name,
+                        "md5_digest": md5_digest,
+                        "file_size": file_size,
+                        "type": _sent_file_type(type(instance)),
+                        "id": instance.id,
+                        "hash": instance.access_hash,
+                    }
+                ],
+                ("id", "hash"),
             )
-            s.commit()
 
     # endregion